@@ -1,35 +1,204 @@
+import asyncio
+import functools
+import hashlib
+import os
+import pickle
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
 import solara
 import duckdb
+import numpy as np
 import pandas as pd
 import plotly.express as px # 雖然程式中沒有使用，但保留
+import pyarrow as pa
 import leafmap.maplibregl as leafmap
 
 # -----------------------------
 # 1. 全域狀態管理
 # -----------------------------
 CITIES_CSV_URL = 'https://data.gishub.org/duckdb/cities.csv'
+# 只在建立 cities 表時讀一次：直接指定數值欄位型別，表中的型別在匯入時就固定，
+# 不依賴自動偵測，之後的查詢也不必再 CAST。
+# 人口用 32 位元整數即可；經緯度維持 DOUBLE，float32 轉成 JSON 時反而會多出雜訊位數
+CITIES_SOURCE = (
+    f"read_csv('{CITIES_CSV_URL}', "
+    "types={'population': 'INTEGER', 'latitude': 'DOUBLE', 'longitude': 'DOUBLE'})"
+)
+APP_CACHE_DIR = Path.home() / ".cache" / "1126duckdb"  # 本程式專用的快取目錄
+COUNTRY_CACHE_PATH = APP_CACHE_DIR / "cities_countries.pkl"  # 國家清單磁碟快取
+COUNTRY_CACHE_VERSION = 3  # 快取內容格式改變時遞增
+CITIES_CACHE_VERSION = 2  # Parquet 欄位格式改變時遞增
+CITIES_PARQUET_TTL = 3600  # 本機快取有效秒數
+
+# 地圖圖層 ID
+SOURCE_ID = "cities"
+CLUSTER_LAYER_ID = "cities-clusters"
+POINT_LAYER_ID = "cities-points"
+COORD_PRECISION = 5  # 座標小數位數 (5 位約 1 公尺)
 
 all_countries = solara.reactive([])
 selected_country = solara.reactive("")
 population_threshold = solara.reactive(1_000_000)  # 人口門檻
+QUERY_DEBOUNCE_SECONDS = 0.3  # 滑桿停止拖曳多久後才查詢
 
-data_df = solara.reactive(pd.DataFrame())
+EMPTY_TABLE = pa.table({})
+data_tbl = solara.reactive(EMPTY_TABLE)  # DuckDB 查詢結果 (Arrow Table)
+display_df = solara.reactive(pd.DataFrame())  # 表格用的 pandas 版本，每次查詢只轉換一次
+requested_country = solara.reactive("")  # 最近一次查詢所要求的國家 (不論成功與否)
+data_version = solara.reactive(0)  # 每次查詢結果更新就 +1，供下游判斷是否需要重算
 
 # -----------------------------
-# 2. 載入國家清單
+# 1-1. 共用 DuckDB 連線 (httpfs 只安裝/載入一次)
 # -----------------------------
-def load_country_list():
+_CON = None
+_CON_LOCK = threading.Lock()  # 保護共用連線的建立
+DUCKDB_THREADS = 4  # 單一查詢內可平行使用的執行緒數
+
+
+_LAST_MODIFIED: dict[str, str] = {}  # 成功取得的 Last-Modified，每個行程只問一次
+
+
+def _remote_last_modified(url):
+    # 以 HEAD 請求取得遠端檔案的 Last-Modified，失敗時回傳 None
+    # 成功的結果留在記憶體，Parquet 與國家清單快取因此用同一個版本判斷；
+    # 失敗不記錄，下次再試，避免一次網路錯誤影響整個行程
+    if url in _LAST_MODIFIED:
+        return _LAST_MODIFIED[url]
     try:
+        request = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(request, timeout=5) as response:
+            last_modified = response.headers.get("Last-Modified")
+    except Exception:
+        return None
+
+    if last_modified is not None:
+        _LAST_MODIFIED[url] = last_modified
+    return last_modified
+
+
+def _cities_parquet_path():
+    # 以「格式版本 + 網址 + Last-Modified」命名：遠端 CSV 或欄位格式改變時自然換成新檔；
+    # 取不到 Last-Modified 時無法判斷版本，回傳 None (不使用 Parquet 快取)
+    last_modified = _remote_last_modified(CITIES_CSV_URL)
+    if last_modified is None:
+        return None
+    key = (CITIES_CACHE_VERSION, CITIES_CSV_URL, last_modified)
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    return APP_CACHE_DIR / f"cities-{digest}.parquet"
+
+
+def _parquet_is_fresh(path):
+    try:
+        return time.time() - path.stat().st_mtime < CITIES_PARQUET_TTL
+    except OSError:
+        return False
+
+
+def _write_parquet_cache(con, path):
+    # 先寫到暫存檔再 os.replace：其他行程只會看到完整的舊檔或新檔
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        con.execute(f"COPY cities TO '{tmp_path}' (FORMAT PARQUET)")
+        os.replace(tmp_path, path)
+    except (OSError, duckdb.Error) as e:
+        print("Error writing cities cache:", e)
+        try:
+            tmp_path.unlink(missing_ok=True)
+        except OSError:
+            pass
+        return
+
+    # 清掉舊版本的快取檔 (只限 _cities_parquet_path 產生的檔名)
+    for old_path in path.parent.glob("cities-*.parquet"):
+        if old_path != path:
+            try:
+                old_path.unlink()
+            except OSError:
+                pass
+
+
+def get_connection():
+    # 呼叫端需持有 _CON_LOCK
+    global _CON
+    if _CON is None:
         con = duckdb.connect()
+        con.execute(f"SET threads = {DUCKDB_THREADS}")
         con.install_extension("httpfs")
         con.load_extension("httpfs")
-        result = con.sql(f"""
+        # 遠端 CSV 只下載、解析一次，之後的查詢都在記憶體中的 cities 表上執行；
+        # 同時存一份 Parquet，重新啟動時在有效期限內直接讀本機檔
+        parquet_path = _cities_parquet_path()
+        loaded = False
+        if parquet_path is not None and _parquet_is_fresh(parquet_path):
+            try:
+                con.execute(f"CREATE TABLE cities AS SELECT * FROM read_parquet('{parquet_path}')")
+                loaded = True
+            except duckdb.Error as e:
+                print("Error reading cities cache:", e)  # 檔案損毀 → 改讀遠端 CSV
+
+        if not loaded:
+            con.execute(f"""
+                CREATE TABLE cities AS
+                SELECT name, country, population, latitude, longitude
+                FROM {CITIES_SOURCE}
+            """)
+            if parquet_path is not None:
+                _write_parquet_cache(con, parquet_path)
+        _CON = con
+    return _CON
+
+
+def get_cursor():
+    # 每個查詢各自開 cursor：共用同一個資料庫 (cities 表)，
+    # 但可在不同執行緒同時執行，不必互相等待
+    with _CON_LOCK:
+        return get_connection().cursor()
+
+# -----------------------------
+# 2. 載入國家清單
+# -----------------------------
+@functools.lru_cache(maxsize=1)
+def _fetch_country_list():
+    # 國家清單幾乎不會變動：同一個行程只查一次 (lru_cache)，
+    # 並以「網址 + Last-Modified」為鍵存到磁碟，重新啟動時直接讀檔；
+    # 取不到 Last-Modified 時無法判斷快取是否過期，直接查詢且不寫檔
+    last_modified = _remote_last_modified(CITIES_CSV_URL)
+    cache_key = (COUNTRY_CACHE_VERSION, CITIES_CSV_URL, last_modified)
+    if last_modified is not None:
+        try:
+            with open(COUNTRY_CACHE_PATH, "rb") as f:
+                cached = pickle.load(f)
+            if cached["key"] == cache_key:
+                return cached["countries"]
+        except Exception:
+            pass  # 沒有快取或快取損毀 → 回到 DuckDB 查詢
+
+    with get_cursor() as cur:
+        rows = cur.sql("""
             SELECT DISTINCT country
-            FROM '{CITIES_CSV_URL}'
+            FROM cities
             ORDER BY country
         """).fetchall()
 
-        country_list = [row[0] for row in result]
+    countries = tuple(row[0] for row in rows)
+    if last_modified is None:
+        return countries
+    try:
+        COUNTRY_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with open(COUNTRY_CACHE_PATH, "wb") as f:
+            pickle.dump({"key": cache_key, "countries": countries}, f)
+    except OSError as e:
+        print("Error writing country cache:", e)
+    return countries
+
+
+def load_country_list():
+    try:
+        country_list = list(_fetch_country_list())
         all_countries.set(country_list)
 
         # 預設選 USA 或第一個
@@ -38,102 +207,195 @@ def load_country_list():
         elif country_list:
             selected_country.set(country_list[0])
 
-        con.close()
     except Exception as e:
         print("Error loading countries:", e)
 
 # -----------------------------
 # 3. 載入該國家 + 人口門檻的城市 (已修正類型轉換)
 # -----------------------------
-def load_filtered_data():
+FILTER_SQL = """
+    SELECT name, country, population, latitude, longitude
+    FROM cities
+    WHERE country = ?
+      AND population >= ?
+    ORDER BY population DESC
+    LIMIT 200
+"""
+
+
+def _query_filtered_data(country_name, threshold):
+    # 以參數綁定取代 f-string：SQL 字串固定不變，國家名稱含引號也不會出錯
+    # 直接取 Arrow Table (零複製)，不經過 pandas
+    with get_cursor() as cur:
+        return cur.execute(FILTER_SQL, [country_name, threshold]).fetch_arrow_table()
+
+
+@functools.lru_cache(maxsize=128)
+def _load_filtered_tables(country_name, threshold):
+    # 在背景執行緒一併轉好表格用的 DataFrame，Page 重繪時不必再轉換
+    # 依 (國家, 門檻) 快取：滑桿拖回先前的值時不必再查詢
+    # (滑桿以 10 萬為一格，鍵值本來就落在同一組格點上)
+    tbl = _query_filtered_data(country_name, threshold)
+    # ArrowDtype 讓 DataFrame 直接沿用 Arrow 緩衝區，字串欄不必轉成 Python 物件
+    return tbl, tbl.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def set_data(tbl, df):
+    # 先換資料再遞增版本，依版本快取的下游才不會拿舊資料配新版本
+    data_tbl.set(tbl)
+    display_df.set(df)
+    data_version.set(data_version.value + 1)
+
+
+async def load_filtered_data():
     country_name = selected_country.value
     threshold = population_threshold.value
 
     if not country_name:
-        data_df.set(pd.DataFrame()); return # 確保返回空 DF 而不是 None
+        set_data(EMPTY_TABLE, pd.DataFrame()); return # 確保返回空 Table 而不是 None
+
+    # 拖曳滑桿時每一格都會觸發新的 task 並取消舊的，
+    # 先等一小段時間，只有最後停下來的值會真的去查詢；
+    # 換國家是單次動作，不需要等待。
+    # 在 await 之前就記下要求的國家：換國家的查詢還在跑或失敗時，滑桿仍會 debounce
+    country_changed = country_name != requested_country.value
+    requested_country.set(country_name)
+    if not country_changed:
+        await asyncio.sleep(QUERY_DEBOUNCE_SECONDS)
 
     try:
-        con = duckdb.connect()
-        con.install_extension("httpfs"); con.load_extension("httpfs")
-
-        # ⭐ 核心修正：使用 CAST(population AS INTEGER) 確保篩選正確性
-        df_result = con.sql(f"""
-            SELECT name, country, population, latitude, longitude
-            FROM '{CITIES_CSV_URL}'
-            WHERE country = '{country_name}'
-              AND CAST(population AS INTEGER) >= {threshold} 
-            ORDER BY population DESC
-            LIMIT 200;
-        """).df()
-
-        # 確保數據類型正確 (這部分保持不變)
-        df_result["latitude"] = df_result["latitude"].astype(float)
-        df_result["longitude"] = df_result["longitude"].astype(float)
-        
-        data_df.set(df_result)
-        con.close()
+        # 查詢丟到背景執行緒，等待網路/DuckDB 時畫面仍可操作
+        tbl, df = await asyncio.to_thread(_load_filtered_tables, country_name, threshold)
+        set_data(tbl, df)
 
     except Exception as e:
         print(f"Error loading filtered cities: {e}")
-        data_df.set(pd.DataFrame())
+        set_data(EMPTY_TABLE, pd.DataFrame())
 
 # -----------------------------
 # 4. Leafmap 地圖元件
 # -----------------------------
+def create_map(center):
+    # 建立地圖並設置底圖，每個地圖只會執行一次
+    m = leafmap.Map(
+        center=center,
+        zoom=4,
+        add_sidebar=True,
+        height="600px"
+    )
+    m.add_basemap("OpenStreetMap", before_id=m.first_symbol_layer_id)
+    return m
+
+
+def build_features(coords, names, pops):
+    # SoA → GeoJSON features；coords 為 (n, 2) 的 [lon, lat] 陣列，
+    # tolist() 直接產生每個點的座標 list，迴圈內只讀區域變數
+    return [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": coord},
+            "properties": {"name": name, "population": population},
+        }
+        for coord, name, population in zip(coords.tolist(), names, pops)
+    ]
+
+
+def build_geojson(tbl):
+    # 回傳 (GeoJSON FeatureCollection, 地圖範圍 [[min_lon, min_lat], [max_lon, max_lat]],
+    #       中心點 [lat, lon])；沒有任何有效座標時範圍與中心點為 None
+    coords = np.column_stack((
+        tbl.column("longitude").to_numpy(),
+        tbl.column("latitude").to_numpy(),
+    ))
+
+    # 缺座標 (NULL → NaN) 的城市無法畫在地圖上，一次向量化遮罩濾掉
+    valid = np.isfinite(coords).all(axis=1)
+    if not valid.all():
+        tbl = tbl.filter(pa.array(valid))
+        coords = coords[valid]
+
+    # 座標只保留 COORD_PRECISION 位小數，縮小 GeoJSON 傳輸量
+    coords = np.round(coords, COORD_PRECISION)
+
+    # 直接取整欄 (SoA)；to_pylist 會把 NULL 轉成 None
+    # country 對每個點都相同 (查詢已依國家篩選)，不放進每個 feature
+    names = tbl.column("name").to_pylist()
+    pops = tbl.column("population").to_pylist()
+
+    geojson = {"type": "FeatureCollection", "features": build_features(coords, names, pops)}
+
+    # 所有城市的範圍：對 (n, 2) 陣列各做一次 min/max，同時得到經度與緯度
+    # 中心點為第一個有座標的城市 (查詢已依人口由大到小排序)
+    bounds = center = None
+    if len(coords):
+        bounds = [coords.min(axis=0).tolist(), coords.max(axis=0).tolist()]
+        lon, lat = coords[0].tolist()
+        center = [lat, lon]
+    return geojson, bounds, center
+
+
 @solara.component
-def CityMap(df: pd.DataFrame):
-    if df.empty:
+def CityMap(tbl: pa.Table, version: int):
+    if tbl.num_rows == 0:
         # 顯示警告訊息，而不是 Info
         return solara.Warning("沒有城市數據符合當前人口門檻。") 
 
-    # 地圖中心點設為人口最大的城市
-    # 確保座標轉換為 float 類型
-    lon = df['longitude'].iloc[0].astype(float)
-    lat = df['latitude'].iloc[0].astype(float)
-    center = [lat, lon]
-
-    # 使用 use_memo 確保地圖只初始化一次
-    m = solara.use_memo(
-        lambda: leafmap.Map(
-            center=center,
-            zoom=4,
-            add_sidebar=True,
-            height="600px"
-        ), []
-    )
-    
-    # 設置底圖和控制項
-    m.add_basemap("OpenStreetMap", before_id=m.first_symbol_layer_id)
+    # GeoJSON 只在查詢結果換版時重建，其他 reactive 觸發的重繪直接沿用
+    geojson, bounds, center = solara.use_memo(lambda: build_geojson(tbl), [version])
 
-    # 轉成 GeoJSON
-    features = []
-    for _, row in df.iterrows():
-        # 顯式轉換數據類型
-        population = int(row["population"]) if pd.notna(row["population"]) else None
-        
-        features.append({
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [float(row["longitude"]), float(row["latitude"])]
-            },
-            "properties": {
-                "name": row["name"],
-                "country": row["country"],
-                "population": population
-            }
-        })
-
-    geojson = {"type": "FeatureCollection", "features": features}
-    
-    # 清除舊圖層 (由於 add_geojson 在 Solara 中會導致圖層疊加)
-    try:
-        # 假設圖層名稱是固定的
-        m.remove_layer("geojson_layer_0") 
-    except Exception:
-        pass
-        
-    m.add_geojson(geojson)
+    # 使用 use_memo 確保地圖 (含底圖) 只初始化一次，
+    # 地圖中心點設為人口最大且有座標的城市 (只在建立時讀取)
+    m = solara.use_memo(lambda: create_map(center or [0, 0]), [])
+
+    def update_layer(geojson, bounds):
+        # 與上次畫的是同一版查詢結果 → 不必再推送到地圖
+        if getattr(m, "_last_version", None) == version:
+            return
+        m._last_version = version
+
+        # 已建立過來源與圖層 → 只用 setData 更新資料，
+        # 不重建 GPU 緩衝區，也保留圖層順序與 cluster 設定
+        if getattr(m, "_city_layer_added", False):
+            m.set_data(SOURCE_ID, geojson)
+        else:
+            # 開啟 cluster：點位由瀏覽器端的 supercluster 聚合，
+            # 點數增加時每個圖磚只需繪製聚合後的圓
+            m.add_source(SOURCE_ID, {
+                "type": "geojson",
+                "data": geojson,
+                "cluster": True,
+                "clusterRadius": 50,
+                "clusterMaxZoom": 14,
+            })
+            m.add_layer({
+                "id": CLUSTER_LAYER_ID,
+                "type": "circle",
+                "source": SOURCE_ID,
+                "filter": ["has", "point_count"],
+                "paint": {
+                    "circle-color": ["step", ["get", "point_count"], "#51bbd6", 10, "#f1f075", 50, "#f28cb1"],
+                    "circle-radius": ["step", ["get", "point_count"], 15, 10, 20, 50, 25],
+                },
+            })
+            m.add_layer({
+                "id": POINT_LAYER_ID,
+                "type": "circle",
+                "source": SOURCE_ID,
+                "filter": ["!", ["has", "point_count"]],
+                "paint": {
+                    "circle-color": "#3388ff",
+                    "circle-radius": 6,
+                    "circle-stroke-width": 1,
+                    "circle-stroke-color": "#ffffff",
+                },
+            })
+            m._city_layer_added = True
+
+        # 縮放到所有城市的範圍
+        if bounds is not None:
+            m.fit_bounds(bounds)
+
+    update_layer(geojson, bounds)
 
     return m.to_solara()
 
@@ -146,8 +408,8 @@ def Page():
     # 初始化：載入國家清單
     solara.use_effect(load_country_list, dependencies=[])
 
-    # 當國家 或 人口門檻 有改變 → 重新查詢 DuckDB
-    solara.use_effect(
+    # 當國家 或 人口門檻 有改變 → 重新查詢 DuckDB (非同步，舊的查詢會被取消)
+    task = solara.lab.use_task(
         load_filtered_data,
         dependencies=[selected_country.value, population_threshold.value]
     )
@@ -170,19 +432,22 @@ def Page():
         )
         solara.Markdown(f"目前人口門檻：**{population_threshold.value:,}**")
 
-    df = data_df.value
+    if task.pending:
+        solara.ProgressLinear(True)
+
+    tbl = data_tbl.value
 
-    if selected_country.value and not df.empty:
+    if selected_country.value and tbl.num_rows:
 
         solara.Markdown(f"## {selected_country.value}（人口 ≥ {population_threshold.value:,}）")
 
         # 由於你的 CityMap 元件調用邏輯複雜，我將直接使用你的 Page 元件的最後部分
         # 表格
         solara.Markdown("###表格")
-        solara.DataFrame(df)
+        solara.DataFrame(display_df.value)
         
         # 地圖
-        CityMap(df) 
+        CityMap(tbl, data_version.value)
         
     elif selected_country.value: 
         solara.Info(f"{selected_country.value} 沒有城市符合當前人口門檻：{population_threshold.value:,}")